@@ -2,21 +2,85 @@ from typing import Dict, List, Tuple, Any, Optional, NoReturn
 import sys
 import os
 import paho.mqtt.client as mqtt
+from paho.mqtt.reasoncodes import ReasonCodes
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 import ssl
+import socket
 import argparse
 import tomllib
 import json
 import time
+import select
+import threading
+import queue
 import logging
 import sdnotify  # type: ignore
-import base64
+import binascii
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
 log = logging.getLogger(__name__)
 
+# ESC/POS real-time status commands
+DLE_EOT_1 = bytes((0x10, 0x04, 0x01))  # transmit printer status
+DLE_EOT_2 = bytes((0x10, 0x04, 0x02))  # transmit offline cause status
+
+# Bits in the response to DLE EOT 1
+EOT1_OFFLINE = 0x08
+EOT1_WAITING_FOR_RECOVERY = 0x20
+
+# Bits in the response to DLE EOT 2
+EOT2_COVER_OPEN = 0x04
+EOT2_PAPER_FEED = 0x08
+EOT2_PAPER_OUT = 0x20
+EOT2_ERROR = 0x40
+
 
 def status_message(text: str, ok: bool) -> Dict[str, Any]:
     return {"status": text, "ok": ok}
 
 
+# Use orjson for the message payloads if it's available; it's much
+# faster than the json module
+if orjson:
+    def encode_message(message: Dict[str, Any]) -> bytes:
+        return orjson.dumps(message)
+
+    def decode_message(payload: bytes) -> Any:
+        return orjson.loads(payload)
+else:
+    def encode_message(message: Dict[str, Any]) -> bytes:
+        return json.dumps(message, separators=(',', ':')).encode()
+
+    def decode_message(payload: bytes) -> Any:
+        return json.loads(payload)
+
+
+class UnixSocketClient(mqtt.Client):
+    # paho can only connect over TCP; this connects to a broker on
+    # the same host through a Unix domain socket instead. There is no
+    # public hook for this: it overrides paho 1.x's private
+    # _create_socket_connection(), and will need revisiting when paho
+    # is upgraded.
+    def __init__(self, socket_path: str, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.socket_path = socket_path
+
+    def _create_socket_connection(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # connect() blocks while the broker's listen backlog is
+            # full; don't hang the network thread on it
+            sock.settimeout(self._connect_timeout)
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+
 class ReceiptPrinter:
     status_offline = status_message("Offline", False)
     status_cover_open = status_message("Cover is open", False)
@@ -28,6 +92,46 @@ class ReceiptPrinter:
     status_not_connected = status_message("Printer not connected", False)
     status_ready = status_message("Ready", True)
 
+    # Payloads for the fixed statuses above, encoded once. Keyed by
+    # id() because the statuses are dicts.
+    _status_payloads = {id(s): encode_message(s) for s in (
+        status_offline, status_cover_open, status_paper_being_fed,
+        status_oop, status_error, status_no_response, status_not_connected,
+        status_ready)}
+
+    # How long to wait for the printer to reply to a status command
+    status_reply_timeout = 0.2
+
+    # A print job may reuse a "ready" status up to this many seconds old
+    # instead of asking the printer again
+    status_max_age = 1.0
+
+    # Applied to the broker connection once it is open. Our messages
+    # are small and latency matters more than throughput, so turn off
+    # Nagle's algorithm.
+    socket_options = (
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_SNDBUF, 65536),
+        (socket.SOL_SOCKET, socket.SO_RCVBUF, 65536),
+    )
+
+    # Number of checks in a row the printer must report itself ready
+    # before we publish that it has recovered
+    status_confirm_count = 2
+
+    # The status timer is considered stuck if it hasn't finished a
+    # tick for this many seconds more than status_check_interval.
+    # Ticks don't wait for printing, but a status probe of a printer
+    # that won't take commands can take up to twice
+    # print_write_timeout.
+    status_tick_timeout = 120.0
+
+    # Give up on a print job or status command if the printer won't
+    # accept any more of it for this many seconds. The printer may
+    # still be taking the end of the previous job, which can take a
+    # while on a slow printer.
+    print_write_timeout = 30.0
+
     def __init__(self, config: Dict[str, Any],
                  notifier: sdnotify.SystemdNotifier) -> None:
         self.printer = config["printer"]
@@ -37,195 +141,496 @@ class ReceiptPrinter:
             prefix = prefix + "/"
         self.status_topic = f"{prefix}status"
         self.print_topic = f"{prefix}print"
+        # Raw print jobs are published to print/[jobid]
+        self.raw_print_topic = f"{prefix}print/+"
         self.printed_topic = f"{prefix}printed"
-        self.mqttc = mqtt.Client(client_id=config["client_id"])
-        self.mqttc.will_set(self.status_topic, json.dumps(self.status_offline),
+        socket_path = config.get("broker_socket_path")
+        if socket_path:
+            self.mqttc = UnixSocketClient(
+                socket_path, client_id=config["client_id"],
+                protocol=mqtt.MQTTv5)
+        else:
+            self.mqttc = mqtt.Client(client_id=config["client_id"],
+                                     protocol=mqtt.MQTTv5)
+        self.mqttc.will_set(self.status_topic,
+                            self.status_payload(self.status_offline),
                             retain=True)
         self.mqttc.username_pw_set(config["username"], config["password"])
-        self.mqttc.tls_set(cert_reqs=ssl.CERT_REQUIRED)
+        if not socket_path:
+            self.mqttc.tls_set(cert_reqs=ssl.CERT_REQUIRED)
+        self.mqttc.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.mqttc.max_inflight_messages_set(config.get("max_inflight", 100))
+        self.mqttc.max_queued_messages_set(config.get("max_queued", 100))
         self.connected = False
         self.current_status = self.status_offline
-        # Print queue is a list of (request-id, data) tuples
-        self.print_queue: List[Tuple[str, bytes]] = []
+        # Print queue of (request-id, data) tuples. It is filled from
+        # paho's network thread and emptied by the printer thread. A
+        # request-id of None means data is a json print request that
+        # the printer thread has yet to decode; we don't want to spend
+        # time on that on paho's network thread. It is bounded so that
+        # jobs can't pile up without limit while the printer is
+        # unavailable.
+        self.print_queue: queue.Queue[Tuple[Optional[str], bytes]] = \
+            queue.Queue(maxsize=config.get("max_queue_length", 100))
+        # The printer thread and the status timer must not talk to the
+        # printer at the same time
+        self._printer_lock = threading.Lock()
+        # The printer is kept open between status checks and jobs;
+        # only use _printer_fd with _printer_lock held
+        self._printer_fd: Optional[int] = None
+        # Time (time.monotonic()) of the last status fetch that found
+        # the printer ready
+        self._last_ready: Optional[float] = None
+        # Written to whenever the main thread has work to do
+        self._wake_fd = os.eventfd(0, os.EFD_NONBLOCK)
+        # Runs check_printer_status() every status_check_interval
+        # once we have connected
+        self._status_timer: Optional[threading.Timer] = None
+        # Time (time.monotonic()) the status timer last finished a tick
+        self._status_heartbeat = time.monotonic()
+        # A recovered status that hasn't been confirmed yet, and how
+        # many checks in a row have reported it
+        self._pending_status: Optional[Dict[str, Any]] = None
+        self._pending_count = 0
+        self._fatal = False
         self.status_check_interval = config.get("status_check_interval", 5.0)
-        self.mqttc.connect_async(config["hostname"], port=config["port"])
+        # Print jobs and replies are sent with QoS 1; keep our session
+        # across reconnects so that anything not yet acknowledged is
+        # redelivered. The session must outlive the connection for that
+        # to work, but not for so long that we print stale jobs after a
+        # long outage.
+        connect_properties = Properties(PacketTypes.CONNECT)
+        connect_properties.SessionExpiryInterval = config.get(
+            "session_expiry_interval", 300)
+        if socket_path:
+            # Not used by UnixSocketClient, but paho insists on them
+            hostname, port = "localhost", 1883
+        else:
+            hostname, port = config["hostname"], config["port"]
+        self.mqttc.connect_async(hostname, port=port,
+                                 clean_start=False,
+                                 properties=connect_properties)
         self.mqttc.on_connect = self.on_connect
+        self.mqttc.on_disconnect = self.on_disconnect
+        self.mqttc.on_socket_open = self.on_socket_open
         self.mqttc.message_callback_add(
             self.print_topic, self.on_print_message)
+        self.mqttc.message_callback_add(
+            self.raw_print_topic, self.on_raw_print_message)
+        self.mqttc.loop_start()
+        self._printer_thread = threading.Thread(
+            target=self._printer_worker, daemon=True)
+        self._printer_thread.start()
+
+    # Every DLE EOT response byte has the form 0xx1xx10. Deleting
+    # _DLE_EOT_DELETE from a reply removes every byte that can't be a
+    # response.
+    _DLE_EOT_DELETE = bytes(b for b in range(256) if (b & 0x93) != 0x12)
+
+    @classmethod
+    def _find_dle_eot_response(cls, r: bytes) -> Optional[int]:
+        matches = r.translate(None, delete=cls._DLE_EOT_DELETE)
+        return matches[0] if matches else None
 
     @staticmethod
-    def _nocreat_opener(path: str, flags: int) -> int:
-        return os.open(path, flags & ~os.O_CREAT)
+    def _read_reply(fd: int, timeout: float) -> bytes:
+        # Wait up to timeout seconds for the printer to have something
+        # for us, then read whatever is there
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        if not poller.poll(timeout * 1000):
+            return b""
+        try:
+            return os.read(fd, 32)
+        except BlockingIOError:
+            return b""
+
+    @classmethod
+    def _drain(cls, fd: int) -> bytes:
+        # Discard anything the printer has sent that we haven't read
+        drained = b""
+        while r := cls._read_reply(fd, 0.0):
+            drained += r
+        return drained
 
     @staticmethod
-    def _find_dle_eot_response(r: bytes) -> Optional[int]:
-        for b in r:
-            if (b & 0x93) == 0x12:
-                return b
-        return None
+    def _write_all(fd: int, data: bytes, timeout: float) -> None:
+        # The printer fd is non-blocking, so the printer may only
+        # accept part of the data at a time
+        poller = select.poll()
+        poller.register(fd, select.POLLOUT)
+        view = memoryview(data)
+        while view:
+            if not poller.poll(timeout * 1000):
+                raise TimeoutError("Printer not accepting data")
+            try:
+                view = view[os.write(fd, view):]
+            except BlockingIOError:
+                pass
+
+    def _ensure_open(self) -> int:
+        # Must be called with _printer_lock held
+        if self._printer_fd is None:
+            fd = os.open(self.printer,
+                         os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+            try:
+                r = self._drain(fd)
+            except IOError:
+                os.close(fd)
+                raise
+            log.debug(f"Opened printer, drained bytes {r=}")
+            self._printer_fd = fd
+        return self._printer_fd
+
+    def _close_printer(self) -> None:
+        # Must be called with _printer_lock held
+        if self._printer_fd is not None:
+            try:
+                os.close(self._printer_fd)
+            except IOError:
+                pass
+            self._printer_fd = None
 
     def fetch_status(self) -> Dict[str, Any]:
-        # Unfortunately this appears to be very sensitive to
-        # timing. Also, we appear to need to close the fd after
-        # sending a command in order to be able to pick up the reply —
-        # using f.flush() doesn't appear to do anything. Frustrating!
+        # Must be called with _printer_lock held.
+        #
+        # This is very sensitive to timing: the printer takes a while
+        # to reply to each command, so we wait for each reply to
+        # become readable. Any stale reply left over from an earlier
+        # command is drained before we start.
         try:
-            with open(self.printer, 'a+b', opener=self._nocreat_opener) as f:
-                log.debug("Draining input buffer")
-                r = f.read(32)
-                log.debug(f"Drained bytes {r=}")
-
-            with open(self.printer, 'a+b', opener=self._nocreat_opener) as f:
-                # DLE EOT 1: "transmit printer status"
-                # response: 0fw1od10
-                # - f = 1 if paper feed button is pressed
-                # - w = 1 if waiting for online recovery
-                # - o = 1 if offline
-                # - d = state of drawer connector pin 3
-                log.debug("Sending DLE EOT 1")
-                f.write(bytes((0x10, 0x04, 0x01)))  # DLE EOT 1
-            time.sleep(0.1)
-            with open(self.printer, 'a+b', opener=self._nocreat_opener) as f:
-                log.debug("Reading...")
-                r = f.read(32)
-                log.debug(f"{r=}")
-                n1 = self._find_dle_eot_response(r)
-                if n1 is None:
-                    log.debug("No valid response to DLE EOT 1")
-                    return self.status_no_response
-                log.debug(f"Read n1={n1:02x}")
-                if not (n1 & 0x28):
-                    return self.status_ready
-            with open(self.printer, 'a+b', opener=self._nocreat_opener) as f:
-                # DLE EOT 2: "transmit offline cause status"
-                # response: 0ep1fc10
-                # - e = 1 if error occurred
-                # - p = 1 if paper out
-                # - f = 1 if paper being fed by paper feed button
-                # - c = 1 if cover is open
-                log.debug("Sending DLE EOT 2")
-                f.write(bytes((0x10, 0x04, 0x02)))  # DLE EOT 2
-            time.sleep(0.1)
-            with open(self.printer, 'a+b', opener=self._nocreat_opener) as f:
-                log.debug("Reading...")
-                r = f.read(32)
-                log.debug(f"{r=}")
-                n2 = self._find_dle_eot_response(r)
-                if n2 is None:
-                    log.debug("No valid response to DLE EOT 2")
-                    return self.status_error
-                log.debug(f"Read n2={n2:02x}")
-                if n2 & 0x04:
-                    return self.status_cover_open
-                if n2 & 0x08:
-                    return self.status_paper_being_fed
-                if n2 & 0x20:
-                    return self.status_oop
-                if n2 & 0x40:
-                    return self.status_error
+            fd = self._ensure_open()
+            log.debug("Draining input buffer")
+            r = self._drain(fd)
+            log.debug(f"Drained bytes {r=}")
+
+            # DLE EOT 1: "transmit printer status"
+            # response: 0fw1od10
+            # - f = 1 if paper feed button is pressed
+            # - w = 1 if waiting for online recovery
+            # - o = 1 if offline
+            # - d = state of drawer connector pin 3
+            log.debug("Sending DLE EOT 1")
+            self._write_all(fd, DLE_EOT_1, self.print_write_timeout)
+            log.debug("Reading...")
+            r = self._read_reply(fd, self.status_reply_timeout)
+            log.debug(f"{r=}")
+            n1 = self._find_dle_eot_response(r)
+            if n1 is None:
+                log.debug("No valid response to DLE EOT 1")
+                return self.status_no_response
+            log.debug(f"Read n1={n1:02x}")
+            if not (n1 & (EOT1_OFFLINE | EOT1_WAITING_FOR_RECOVERY)):
+                return self.status_ready
+
+            # DLE EOT 2: "transmit offline cause status"
+            # response: 0ep1fc10
+            # - e = 1 if error occurred
+            # - p = 1 if paper out
+            # - f = 1 if paper being fed by paper feed button
+            # - c = 1 if cover is open
+            log.debug("Sending DLE EOT 2")
+            self._write_all(fd, DLE_EOT_2, self.print_write_timeout)
+            log.debug("Reading...")
+            r = self._read_reply(fd, self.status_reply_timeout)
+            log.debug(f"{r=}")
+            n2 = self._find_dle_eot_response(r)
+            if n2 is None:
+                log.debug("No valid response to DLE EOT 2")
+                return self.status_error
+            log.debug(f"Read n2={n2:02x}")
+            if n2 & EOT2_COVER_OPEN:
+                return self.status_cover_open
+            if n2 & EOT2_PAPER_FEED:
+                return self.status_paper_being_fed
+            if n2 & EOT2_PAPER_OUT:
+                return self.status_oop
+            if n2 & EOT2_ERROR:
+                return self.status_error
+        except TimeoutError:
+            log.debug("Printer not accepting status commands")
+            return self.status_no_response
         except IOError as e:
             log.debug(f"printer not connected {e=}")
+            self._close_printer()
             return self.status_not_connected
         return status_message(
             f"Unrecognised printer status: {n1=} {n2=}", False)
 
+    def status_payload(self, status: Dict[str, Any]) -> bytes:
+        payload = self._status_payloads.get(id(status))
+        if payload is None:
+            payload = encode_message(status)
+        return payload
+
+    def get_status(self, max_age: Optional[float] = None) -> Dict[str, Any]:
+        # Must be called with _printer_lock held
+        now = time.monotonic()
+        if max_age is not None and self._last_ready is not None \
+           and now - self._last_ready < max_age:
+            return self.status_ready
+        status = self.fetch_status()
+        self._last_ready = now if status['ok'] else None
+        return status
+
     def check_printer_status(self) -> None:
-        new_status = self.fetch_status()
-        if new_status != self.current_status:
-            self.current_status = new_status
-            self.mqttc.publish(
-                self.status_topic, json.dumps(self.current_status),
-                retain=True)
+        # If the printer thread is busy printing, leave the status
+        # alone until the next check: print_jobs() has just fetched
+        # it, and waiting for the batch to finish would hold up the
+        # status timer for as long as the batch takes
+        if not self._printer_lock.acquire(blocking=False):
+            return
+        try:
+            new_status = self.get_status()
+        finally:
+            self._printer_lock.release()
+        if new_status == self.current_status:
+            self._pending_status = None
+            return
+        # Problems are published straight away, but a printer that
+        # claims to have recovered must keep saying so for
+        # status_confirm_count checks in a row before we believe it;
+        # this stops a printer that flaps between states while paper
+        # is being loaded from flooding the status topic. The first
+        # status after connecting is always published, since the
+        # broker will be showing our Will.
+        if new_status['ok'] and self.current_status is not self.status_offline:
+            if new_status != self._pending_status:
+                self._pending_status = new_status
+                self._pending_count = 0
+            self._pending_count += 1
+            if self._pending_count < self.status_confirm_count:
+                return
+        self._pending_status = None
+        self.current_status = new_status
+        self.mqttc.publish(
+            self.status_topic, self.status_payload(self.current_status),
+            retain=True)
+
+    def _arm_status_timer(self, delay: float) -> None:
+        self._status_timer = threading.Timer(delay, self._on_status_tick)
+        self._status_timer.daemon = True
+        self._status_timer.start()
+
+    def _on_status_tick(self) -> None:
+        try:
+            if self.connected:
+                self.check_printer_status()
+        finally:
+            self._status_heartbeat = time.monotonic()
+            self._arm_status_timer(self.status_check_interval)
+
+    def _problem(self) -> Optional[str]:
+        # Returns a description of the first thread found not to be
+        # doing its job, or None if all is well
+        if not self._printer_thread.is_alive():
+            return "printer thread has died"
+        # paho 1.x keeps the thread started by loop_start() in _thread
+        network_thread = self.mqttc._thread
+        if network_thread is None or not network_thread.is_alive():
+            return "mqtt network thread has died"
+        if self._status_timer is not None:
+            age = time.monotonic() - self._status_heartbeat
+            if age > self.status_check_interval + self.status_tick_timeout:
+                return f"status timer stuck for {age:.0f}s"
+        return None
 
     def on_connect(self, client: mqtt.Client, userdata: Any,
-                   flags: Dict[str, int], rc: int) -> None:
+                   flags: Dict[str, int], rc: ReasonCodes,
+                   properties: Optional[Properties] = None) -> None:
         log.debug(f"on_connect {rc=}")
-        if rc == 5:
+        if rc in (134, 135):  # Bad user name or password, Not authorized
             log.fatal("mqtt: Not authorised")
-            sys.exit(1)
+            # We are on paho's network thread here; sys.exit() would
+            # only end that thread, so ask the main thread to do it.
+            self._fatal = True
+            os.eventfd_write(self._wake_fd, 1)
+            return
 
         # XXX deal with all other known rc values here!
 
         if rc == 0:
             log.debug("Connected")
             self.connected = True
-            client.subscribe(self.print_topic, 0)
+            client.subscribe([(self.print_topic, 1),
+                              (self.raw_print_topic, 1)])
+            if self._status_timer is None:
+                self._arm_status_timer(0.0)
+
+    def on_socket_open(self, client: mqtt.Client, userdata: Any,
+                       sock: socket.socket) -> None:
+        if sock.family == socket.AF_UNIX:
+            return
+        for level, option, value in self.socket_options:
+            sock.setsockopt(level, option, value)
+
+    def on_disconnect(self, client: mqtt.Client, userdata: Any,
+                      rc: ReasonCodes,
+                      properties: Optional[Properties] = None) -> None:
+        log.debug(f"Disconnected {rc=}")
+        # paho reconnects by itself; make sure we publish the status
+        # again once it has done so
+        self.connected = False
+        self.current_status = self.status_offline
 
     def on_print_message(self, client: mqtt.Client, userdata: Any,
                          msg: mqtt.MQTTMessage) -> None:
         try:
-            req = json.loads(msg.payload)
-            log.debug(f"{req=}")
-        except json.JSONDecodeError:
-            log.info(f"Ignoring non-JSON print request {msg.payload=}")
+            self.print_queue.put_nowait((None, msg.payload))
+        except queue.Full:
+            # We need the jobid to tell the client
+            req = self._parse_request(msg.payload)
+            if req is not None:
+                self.reject_job(str(req["jobid"]))
+
+    def on_raw_print_message(self, client: mqtt.Client, userdata: Any,
+                             msg: mqtt.MQTTMessage) -> None:
+        # The payload is the job itself, and the jobid is the last
+        # level of the topic
+        jobid = msg.topic.rsplit("/", 1)[-1]
+        if not jobid:
+            log.info(f"Ignoring raw print request missing jobid: {msg.topic=}")
             return
-        if "jobid" not in req:
-            log.info(f"Ignoring print request missing jobid: {req=}")
+        if not msg.payload:
+            log.info(f"Responding to raw print request missing data: {jobid=}")
+            self.send_print_status(jobid, "Aborted: missing data")
             return
+        try:
+            self.print_queue.put_nowait((jobid, msg.payload))
+        except queue.Full:
+            self.reject_job(jobid)
+
+    def reject_job(self, jobid: str) -> None:
+        log.info(f"Print queue full, rejecting job {jobid=}")
+        self.send_print_status(jobid, "Queue full", success=False)
+
+    @staticmethod
+    def _parse_request(payload: bytes) -> Optional[Dict[str, Any]]:
+        try:
+            req = decode_message(payload)
+            log.debug(f"{req=}")
+        except (ValueError, RecursionError):
+            # json.loads() raises UnicodeDecodeError rather than
+            # JSONDecodeError for bytes that aren't valid UTF-8; both
+            # are ValueErrors. Deeply nested input can also exceed the
+            # recursion limit.
+            log.info(f"Ignoring non-JSON print request {payload=}")
+            return None
+        if not isinstance(req, dict) or "jobid" not in req:
+            log.info(f"Ignoring print request missing jobid: {req=}")
+            return None
+        return req
+
+    def decode_request(self, payload: bytes) -> Optional[Tuple[str, bytes]]:
+        req = self._parse_request(payload)
+        if req is None:
+            return None
         jobid = str(req["jobid"])
         if "data" not in req:
             log.info(f"Responding to print request missing data: {req=}")
             self.send_print_status(jobid, "Aborted: missing data")
-            return
+            return None
         try:
-            data = base64.b64decode(req["data"])
+            # binascii decodes straight from the str, unlike
+            # base64.b64decode() which makes an ASCII copy of it first
+            data = binascii.a2b_base64(req["data"])
         except Exception as e:
             log.info(f"Error decoding print data: {req=}")
             self.send_print_status(jobid, f"Error decoding data: {e=}")
-            return
-        self.print_queue.append((jobid, data))
+            return None
+        return jobid, data
 
     def send_print_status(
             self, jobid: str, message: str,
             finished: bool = True, success: bool = False) -> None:
-        self.mqttc.publish(self.printed_topic, json.dumps({
+        info = self.mqttc.publish(self.printed_topic, encode_message({
             "jobid": jobid,
             "status": message,
             "finished": finished,
             "success": success,
-        }))
+        }), qos=1)
+        # paho refuses the message outright once max_queued messages
+        # are waiting to go out, for example during a long outage
+        if info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+            log.warning(f"Outgoing queue full, dropped print status "
+                        f"{jobid=} {message=}")
 
-    def run(self) -> NoReturn:
-        status_check_deadline = 0.0
+    def print_jobs(self, jobs: List[Tuple[str, bytes]]) -> None:
+        # Must be called with _printer_lock held. Checks the status
+        # once for the whole batch.
+        status = self.get_status(max_age=self.status_max_age)
+        if not status['ok']:
+            for jobid, data in jobs:
+                self.send_print_status(
+                    jobid, status['status'], success=False)
+            return
+        done = 0
+        try:
+            fd = self._ensure_open()
+            for jobid, data in jobs:
+                self._write_all(fd, data, self.print_write_timeout)
+                done += 1
+                self.send_print_status(jobid, "Printed", success=True)
+        except Exception as e:
+            self._close_printer()
+            self._last_ready = None
+            for jobid, data in jobs[done:]:
+                self.send_print_status(
+                    jobid, f"Print failed: {e=}", success=False)
+
+    def _printer_worker(self) -> NoReturn:
+        # Owns the printer for printing. Takes whatever jobs have
+        # queued up together, so a burst of jobs shares a single status
+        # check and open of the printer.
         while True:
-            self.notifier.notify("WATCHDOG=1")
-            if self.print_queue:
-                jobid, data = self.print_queue.pop(0)
-                status = self.fetch_status()
-                if status['ok']:
+            items = [self.print_queue.get()]
+            try:
+                while True:
+                    items.append(self.print_queue.get_nowait())
+            except queue.Empty:
+                pass
+            # Nothing a single job does may stop this thread, or
+            # nothing would ever be printed again
+            jobs = []
+            for jobid, data in items:
+                if jobid is None:
                     try:
-                        with open(self.printer, 'ab',
-                                  opener=self._nocreat_opener) as f:
-                            f.write(data)
-                            self.send_print_status(
-                                jobid, "Printed", success=True)
-                    except Exception as e:
-                        self.send_print_status(
-                            jobid, f"Print failed: {e=}", success=False)
-                else:
-                    self.send_print_status(
-                        jobid, status['status'], success=False)
-
-            while not self.connected:
+                        job = self.decode_request(data)
+                    except Exception:
+                        log.exception(f"Error decoding print request {data=}")
+                        continue
+                    if job is None:
+                        continue
+                    jobid, data = job
+                jobs.append((jobid, data))
+            if jobs:
                 try:
-                    log.debug("Trying to connect...")
-                    self.mqttc.reconnect()
-                    self.connected = True
-                except ConnectionRefusedError:
-                    log.debug("Connection refused, waiting...")
-                    time.sleep(1)
+                    with self._printer_lock:
+                        self.print_jobs(jobs)
+                except Exception:
+                    log.exception("Error printing jobs")
 
-            if self.connected:
-                now = time.time()
-                if status_check_deadline <= now:
-                    self.check_printer_status()
-                    status_check_deadline = now + self.status_check_interval
-                timeout = max(status_check_deadline - now, 0.0)
-                rc = self.mqttc.loop(timeout=timeout)
-                if rc == mqtt.MQTT_ERR_CONN_LOST:
-                    log.debug("Disconnected")
-                    self.current_status = self.status_offline
-                    self.connected = False
+    def run(self) -> NoReturn:
+        # Printing and status checks happen on their own threads; all
+        # we do here is tell the watchdog while they are all working,
+        # and exit if another thread asks us to. systemd tells us how
+        # often it wants to hear from the watchdog; tell it twice as
+        # often as that. If a thread stops working we stay quiet, and
+        # systemd restarts us.
+        watchdog_usec = os.environ.get("WATCHDOG_USEC")
+        timeout = int(watchdog_usec) / 2000 if watchdog_usec else None
+        poller = select.poll()
+        poller.register(self._wake_fd, select.POLLIN)
+        while True:
+            problem = self._problem()
+            if problem:
+                log.error(f"Not notifying watchdog: {problem}")
+            else:
+                self.notifier.notify("WATCHDOG=1")
+            if poller.poll(timeout):
+                os.eventfd_read(self._wake_fd)
+            if self._fatal:
+                sys.exit(1)
 
 
 if __name__ == "__main__":